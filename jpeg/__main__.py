@@ -25,9 +25,18 @@ def test_dct_idct_identity():
     b = dct.dct(dct.idct(a))
     assert np.max(np.abs(a - b)) < 1e-9
 
+def test_idct_matrix():
+    dct = DCT()
+    q = np.random.randint(1, 256, (8, 8))
+    c = np.random.randint(-1024, 1024, (8, 8))
+    a = dct.idct(c * q)
+    b = (c.flatten() @ dct.idct_matrix(q)).reshape(8, 8)
+    assert np.max(np.abs(a - b)) < 1e-9
+
 def run_test():
     test_upsample()
     test_dct_idct_identity()
+    test_idct_matrix()
     files = ["monalisa", "gig-sn01", "gig-sn08", "teatime"]
     for file in files:
         img = JPEG().decode(open(f"Image/{file}.jpg", "rb"))
@@ -1,4 +1,5 @@
 DEBUG = False
-def debug(*args, **kwargs):
-    if not DEBUG: return
-    print(*args, **kwargs)
+if DEBUG:
+    debug = print
+else:
+    def debug(*args, **kwargs): pass
@@ -1,13 +1,15 @@
 import numpy as np
 
 import math
+import os
+import re
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from io import BytesIO
-from struct import unpack
+from struct import Struct
 from typing import BinaryIO
 
-from .debug import debug
+from .debug import DEBUG, debug
 from .misc import *
 from .image import upsample, ycbcr2bgr
 
@@ -30,36 +32,77 @@ MARKERS = {
     'COM': b'\xff\xfe',
 }
 
-MARKERS_MAP = {
-    MARKERS[k]: k for k in MARKERS
-}
+_U8 = Struct('B')
+_U16BE = Struct('>H')
+_HT16 = Struct('16B')
+_SOF0 = Struct('>BHHB')
+_SOF_COMP = Struct('BBB')
+_SOS_COMP = Struct('BB')
 
-def unpack_int4(b: bytes):
-    return divmod(unpack('B', b)[0], 0x10)
+# any 0xFF that is not a stuffed 0xFF00 starts a marker
+_MARKER = re.compile(b'\xff(?!\x00)')
 
-def ensure_range(stream: BinaryIO, varname: str, value: int, min_value: int, max_value: int):
+def ensure_range(data: bytes, pos: int, varname: str, value: int, min_value: int, max_value: int):
     if min_value <= value <= max_value: return
-    raise JPEGDecodeError(f"Expecting {varname} in the range [{min_value}, {max_value}] but was {value}", stream, stream.tell())
+    raise JPEGDecodeError(f"Expecting {varname} in the range [{min_value}, {max_value}] but was {value}", data, pos)
 
-def ensure_set(stream: BinaryIO, varname: str, value: int, st: list):
+def ensure_set(data: bytes, pos: int, varname: str, value: int, st: list):
     if value in st: return
-    raise JPEGDecodeError(f"Expecting {varname} in the set {st} but was {value}", stream, stream.tell())
+    raise JPEGDecodeError(f"Expecting {varname} in the set {st} but was {value}", data, pos)
 
-def ensure_eos(stream: BinaryIO):
-    b = stream.read(1)
-    if not b: return
-    raise JPEGDecodeError(f"Expecting end of segment but 0x{b.hex()} was found", stream, stream.tell())
+def ensure_eos(data: bytes, pos: int):
+    if pos >= len(data): return
+    raise JPEGDecodeError(f"Expecting end of segment but 0x{data[pos: pos + 1].hex()} was found", data, pos)
 
 @dataclass
 class ScanParam():
     Cs: int
     H: int
     V: int
-    qt: list[int]
+    qt: np.ndarray # 8x8, natural order
     dc: HuffmanTable
     ac: HuffmanTable
     dc_acc: int = 0
 
+def decode_block(param: ScanParam, stream: BitStream, c: np.ndarray, zz: list[int]):
+    # F.2.2 Decoding of one 8x8 block into c, coefficients in natural order.
+    # This is the innermost loop of the decoder, so the bit buffer of stream
+    # is worked on in locals and Huffman lookup and EXTEND are done inline.
+    data, pos, buf, bits = stream.data, stream.pos, stream.buf, stream.bits
+    lookup = param.dc.lookup
+    k = 0
+    while k < 64:
+        # enough for the longest code plus its additional bits
+        if bits < 32:
+            pos, buf, bits = refill(data, pos, buf, bits)
+        entry = lookup[(buf >> (bits - 16)) & 0xffff]
+        if entry == 0:
+            raise JPEGDecodeError("Invalid Huffman code", stream, 8 * pos - bits)
+        bits -= entry & 0xff
+        # DC symbols are just a size, AC symbols are a run and a size
+        R, L = entry >> 12, (entry >> 8) & 0x0f
+        v = 0
+        if L:
+            bits -= L
+            v = (buf >> bits) & ((1 << L) - 1)
+            if v >> (L - 1) == 0:
+                v += EXTEND_OFFSET[L]
+        if k == 0:
+            # Differential DC encoding
+            param.dc_acc += v
+            c[0] = param.dc_acc
+            lookup = param.ac.lookup
+        else:
+            # Run-length encoding
+            if R == L == 0: # EOB
+                break
+            k += R
+            if k >= 64:
+                raise JPEGDecodeError(f"Expecting 64 elements in block but was {k + 1}", stream, 8 * pos - bits)
+            c[zz[k]] = v
+        k += 1
+    stream.pos, stream.buf, stream.bits = pos, buf, bits
+
 class JPEG:
     def __init__(self):
         self.qts = {}
@@ -69,68 +112,85 @@ class JPEG:
         self.P = 8
         self.Y = self.X = -1
         self.scan = []
+        # segment handlers indexed by the byte following 0xFF in their marker
+        self.handlers = [None] * 256
+        for marker, handler in [
+            ('APP0', self.skip), ('COM', self.skip),
+            ('DQT', self.dqt), ('SOF0', self.sof0), ('DHT', self.dht), ('SOS', self.sos),
+        ]:
+            self.handlers[MARKERS[marker][1]] = handler
+
+    def skip(self, segment: bytes):
+        pass
 
     def dqt(self, segment: bytes):
         # B.2.4.1 Quantization table-specification syntax
-        stream = BytesIO(segment)
-        while True:
-            PqTq = stream.read(1)
-            if not PqTq: break
-            Pq, Tq = unpack_int4(PqTq)
-            if Pq != 0: raise JPEGDecodeError(f"Unknown Pq {Pq}", stream, stream.tell())
-            Q = unpack('B' * 64, stream.read(64))
-            self.qts[Tq] = np.array(Q)
-        ensure_eos(stream)
+        off = 0
+        while off < len(segment):
+            Pq, Tq = segment[off] >> 4, segment[off] & 0x0F
+            off += 1
+            if Pq != 0: raise JPEGDecodeError(f"Unknown Pq {Pq}", segment, off)
+            Q = np.frombuffer(segment, dtype=np.uint8, count=64, offset=off)
+            off += 64
+            # kept in natural order so that dequantization is a single multiply
+            self.qts[Tq] = ziglag(Q.astype(np.float32))
+        ensure_eos(segment, off)
 
     def sof0(self, segment: bytes):
         # B.2.2 Frame header syntax
-        stream = BytesIO(segment)
-        P, Y, X, Nf = unpack('>BHHB', stream.read(6))
-        if P != 8: raise JPEGDecodeError(f"Expecting P = 8 for baseline decoding but was {P}", stream, stream.tell())
-        if Nf != 3: raise JPEGDecodeError(f"Expecting YCbCr mode but Nf = {Nf}", stream, stream.tell())
+        P, Y, X, Nf = _SOF0.unpack_from(segment, 0)
+        off = _SOF0.size
+        if P != 8: raise JPEGDecodeError(f"Expecting P = 8 for baseline decoding but was {P}", segment, off)
+        if Nf != 3: raise JPEGDecodeError(f"Expecting YCbCr mode but Nf = {Nf}", segment, off)
         for _ in range(Nf):
-            C, HV, Tq = unpack('BBB', stream.read(3))
-            H, V = divmod(HV, 0x10)
-            ensure_set(stream, 'H', H, [1, 2, 4])
-            ensure_set(stream, 'V', V, [1, 2, 4])
+            C, HV, Tq = _SOF_COMP.unpack_from(segment, off)
+            off += _SOF_COMP.size
+            H, V = HV >> 4, HV & 0x0F
+            ensure_set(segment, off, 'H', H, [1, 2, 4])
+            ensure_set(segment, off, 'V', V, [1, 2, 4])
             self.csp[C] = {'H': H, 'V': V, 'Tq': Tq}
         self.P = P
         self.Y, self.X = Y, X
-        ensure_eos(stream)
+        ensure_eos(segment, off)
 
     def dht(self, segment: bytes):
         # B.2.4.2 Huffman table-specification syntax
-        stream = BytesIO(segment)
-        while True:
-            TcTh = stream.read(1)
-            if not TcTh: break
-            Tc, Th = unpack_int4(TcTh)
-            ensure_range(stream, 'Tc', Tc, 0, 1)
-            L = unpack('B' * 16, stream.read(16))
-            V = [unpack('B' * L[i], stream.read(L[i])) for i in range(16)]
+        off = 0
+        while off < len(segment):
+            Tc, Th = segment[off] >> 4, segment[off] & 0x0F
+            off += 1
+            ensure_range(segment, off, 'Tc', Tc, 0, 1)
+            L = _HT16.unpack_from(segment, off)
+            off += 16
+            V = []
+            for i in range(16):
+                V.append(tuple(segment[off: off + L[i]]))
+                off += L[i]
             if Tc == 0: self.dcs[Th] = HuffmanTable(V)
             else: self.acs[Th] = HuffmanTable(V)
-        ensure_eos(stream)
+        ensure_eos(segment, off)
 
     def sos(self, segment: bytes):
         # B.2.3 Scan header syntax
-        stream = BytesIO(segment)
-        Ns = unpack('B', stream.read(1))[0]
+        Ns = _U8.unpack_from(segment, 0)[0]
+        off = 1
         for _ in range(Ns):
-            Cs, TdTa = unpack('BB', stream.read(2))
-            Td, Ta = divmod(TdTa, 0x10)
+            Cs, TdTa = _SOS_COMP.unpack_from(segment, off)
+            off += _SOS_COMP.size
+            Td, Ta = TdTa >> 4, TdTa & 0x0F
             self.scan.append({'Cs': Cs, 'Td': Td, 'Ta': Ta})
-        stream.read(3) # Ss, Se, Ah, Al
-        ensure_eos(stream)
+        off += 3 # Ss, Se, Ah, Al
+        ensure_eos(segment, off)
 
     def decode_ecs(self, segment: bytes):
-        debug('QT:', self.qts)
-        debug('DC:', self.dcs)
-        debug('AC:', self.acs)
-        debug('CSP:', self.csp)
-        debug('Y X:', self.Y, self.X)
-        debug('scan:', self.scan)
-        debug(len(segment))
+        if DEBUG:
+            debug('QT:', self.qts)
+            debug('DC:', self.dcs)
+            debug('AC:', self.acs)
+            debug('CSP:', self.csp)
+            debug('Y X:', self.Y, self.X)
+            debug('scan:', self.scan)
+            debug(len(segment))
 
         # A.1.1 Dimensions and sampling factors
         Vmax = max(x['V'] for x in self.csp.values())
@@ -148,103 +208,91 @@ class JPEG:
                 self.qts[b['Tq']], self.dcs[a['Td']], self.acs[a['Ta']]
             ))
 
+        MY, MX = Y // MCU_Y, X // MCU_X
+        # A.2.3 Interleaved order: the blocks making up one MCU
+        mcu = [param for param in scan for _ in range(param.V * param.H)]
+
         stream = BitStream(segment)
-        img = np.zeros((3, Y, X), dtype=int)
+        # each component is reconstructed at its own resolution; samples are
+        # range-limited right after the IDCT, so 8-bit planes suffice
+        planes = [np.zeros((8 * MY * param.V, 8 * MX * param.H), dtype=np.uint8) for param in scan]
+        # quantized coefficients of every block in decode order, each block in natural order
+        coef = np.zeros((MY * MX * len(mcu), 64), dtype=np.int16)
 
-        dct = DCT()
-        def decode_block(param: ScanParam):
-            c = []
-            # Differential DC encoding
-            T = param.dc.next(stream)
-            diff = stream.read_signed(T)
-            param.dc_acc += diff
-            c.append(param.dc_acc)
+        # entropy-decode the whole scan in one pass
+        zz = UNZIGZAG.tolist()
+        for n in range(len(coef)):
+            decode_block(mcu[n % len(mcu)], stream, coef[n], zz)
 
-            # Run-length encoding
-            while len(c) < 64:
-                R, L = divmod(param.ac.next(stream), 16)
-                if R == L == 0: # EOB
-                    c += [0] * (64 - len(c))
-                    break
-                c += [0] * R
-                c.append(stream.read_signed(L))
-            if len(c) != 64:
-                raise JPEGDecodeError(f"Expecting 64 elements in block but was {len(c)}", stream, stream.tell())
-
-            # Dequantization
-            a = ziglag(np.array(c) * param.qt)
-
-            # IDCT
-            a = np.round(dct.idct(a)).astype(int)
-
-            # A.3.1 Level shift
-            a += 2 ** (self.P - 1)
-            return a
-
-        def decode_mcu():
-            mcu = np.zeros((3, MCU_Y, MCU_X), dtype=int)
-            for param in scan:
-                buf = np.zeros((8 * param.V, 8 * param.H), dtype=int)
-                for i in range(param.V):
-                    for j in range(param.H):
-                        buf[8 * i: 8 * i + 8, 8 * j: 8 * j + 8] = decode_block(param)
-                mcu[param.Cs - 1] = upsample(buf, Vmax // param.V, Hmax // param.H)
-            return mcu
-
-        for i in range(0, Y, MCU_Y):
-            for j in range(0, X, MCU_X):
-                img[:, i: i + MCU_Y, j: j + MCU_X] = decode_mcu()
-        return img
+        # lay the blocks of each component out on that component's block grid
+        coef = coef.reshape(MY, MX, len(mcu), 64)
+        coefs = []
+        off = 0
+        for param in scan:
+            a = coef[:, :, off: off + param.V * param.H].reshape(MY, MX, param.V, param.H, 64)
+            coefs.append(a.transpose(0, 2, 1, 3, 4).reshape(MY * param.V, MX * param.H, 64))
+            off += param.V * param.H
 
-    def decode(self, stream: BinaryIO):
-        def __read_int16():
-            return unpack('>H', stream.read(2))[0]
+        # Once entropy-decoded, MCU rows are independent of each other. The
+        # bulk of the work below is numpy code that releases the GIL, so the
+        # rows are reconstructed concurrently.
+        dct = DCT(np.float32)
+        # dequantization folded into the IDCT of each component
+        idcts = [dct.idct_matrix(param.qt) for param in scan]
+        level_shift, maxval = 1 << (self.P - 1), (1 << self.P) - 1
+        def decode_row(i: int):
+            for param, coef, K, plane in zip(scan, coefs, idcts, planes):
+                # Dequantization and IDCT of all blocks of the row as one matrix product
+                a = np.round(coef[i * param.V: (i + 1) * param.V] @ K)
+                # A.3.1 Level shift
+                a += level_shift
+                np.clip(a, 0, maxval, out=a)
+                # (V, blocks per line, 8, 8) -> (8V, 8 * blocks per line)
+                a = a.reshape(param.V, -1, 8, 8).transpose(0, 2, 1, 3).reshape(8 * param.V, -1)
+                plane[i * 8 * param.V: (i + 1) * 8 * param.V] = a
 
-        def __expect_bytes(p: bytes):
-            q = stream.read(len(p))
-            if q != p:
-                raise JPEGDecodeError(f"Expecting value 0x{p.hex()} but was 0x{q.hex()}", stream, stream.tell())
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            list(pool.map(decode_row, range(MY)))
+        # A.1.1 Upsample every component plane to the full image resolution at once
+        img = [None] * 3
+        for param, plane in zip(scan, planes):
+            img[param.Cs - 1] = upsample(plane, Vmax // param.V, Hmax // param.H)
+        return img
+
+    def decode(self, stream: BinaryIO | bytes):
+        # The whole file is parsed in memory; segments are handed out as
+        # zero-copy memoryview slices.
+        data = stream if isinstance(stream, (bytes, bytearray)) else stream.read()
+        mv = memoryview(data)
 
         img = None
-        __expect_bytes(MARKERS['SOI'])
+        if data[:2] != MARKERS['SOI']:
+            raise JPEGDecodeError(f"Expecting value 0x{MARKERS['SOI'].hex()} but was 0x{data[:2].hex()}", data, 0)
+        pos = 2
         while True:
-            marker = stream.read(2)
-            if marker not in MARKERS_MAP:
-                raise JPEGDecodeError(f"Unexpected marker 0x{marker.hex()}", stream, stream.tell())
-            marker = MARKERS_MAP[marker]
-            if marker == 'SOI':
-                raise JPEGDecodeError(f"Unexpected marker {marker}", stream, stream.tell())
-            if marker == 'EOI':
+            marker = data[pos: pos + 2]
+            pos += 2
+            if marker == MARKERS['EOI']:
                 break
-            L = __read_int16()
-            segment = stream.read(L - 2)
-
-            if marker == 'APP0' or marker == 'COM':
-                continue
-            if marker == 'DQT':
-                self.dqt(segment)
-            elif marker == 'SOF0':
-                self.sof0(segment)
-            elif marker == 'DHT':
-                self.dht(segment)
-            elif marker == 'SOS':
-                self.sos(segment)
-                segment = []
-                while True:
-                    val = stream.read(1)
-                    if val == b'\xff': val += stream.read(1)
-                    if val == b'\xff\x00': val = b'\xff'
-                    if len(val) == 2: # marker
-                        stream.seek(-2, 1)
-                        break
-                    segment.append(val)
-                img = self.decode_ecs(b''.join(segment))
-        ensure_eos(stream)
+            handler = self.handlers[marker[1]] if len(marker) == 2 and marker[0] == 0xff else None
+            if handler is None:
+                raise JPEGDecodeError(f"Unexpected marker 0x{marker.hex()}", data, pos)
+            L = _U16BE.unpack_from(data, pos)[0]
+            segment = mv[pos + 2: pos + L]
+            pos += L
+            handler(segment)
+
+            if marker == MARKERS['SOS']:
+                # B.1.1.5 Entropy-coded data segments run up to the next marker,
+                # which the loop then handles like any other
+                m = _MARKER.search(data, pos)
+                if not m:
+                    raise JPEGDecodeError("Expecting a marker after entropy-coded segment", data, pos)
+                end = m.start()
+                img = self.decode_ecs(data[pos: end].replace(b'\xff\x00', b'\xff'))
+                pos = end
+        ensure_eos(data, pos)
         if img is None: return None
-        img = img[:, :self.Y, :self.X]
-        img = ycbcr2bgr(img, 2 ** (self.P - 1))
-        img = np.clip(np.round(img), 0, 2 ** self.P - 1)
+        img = [plane[:self.Y, :self.X] for plane in img]
         assert self.P == 8
-        img = img.astype(np.uint8)
-        img = img.transpose(1, 2, 0)
-        return img
+        return ycbcr2bgr(img, 1 << (self.P - 1))
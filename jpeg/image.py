@@ -1,20 +1,31 @@
 import numpy as np
 
-def upsample_v(img: np.ndarray, k: int):
-    ret = np.zeros((img.shape[0] * k, img.shape[1]), dtype=int)
-    for i in range(k):
-        ret[i::k, :] = img
-    return ret
-
 def upsample(img: np.ndarray, kv: int, kh: int):
-    img = upsample_v(img, kv).T
-    img = upsample_v(img, kh).T
-    return img
+    if kv == kh == 1: return img
+    h, w = img.shape
+    return np.broadcast_to(img[:, None, :, None], (h, kv, w, kh)).reshape(h * kv, w * kh)
+
+# JFIF conversion coefficients in Q16 fixed point
+CB_B = 116130 # 1.772
+CB_G = -22554 # -0.34414
+CR_G = -46802 # -0.71414
+CR_R = 91881 # 1.402
 
 def ycbcr2bgr(img: np.ndarray, shift):
     # https://www.w3.org/Graphics/JPEG/jfif3.pdf
-    Y, Cb, Cr = img[0], img[1] - shift, img[2] - shift
-    R = Y + 1.402 * Cr
-    G = Y - 0.34414 * Cb - 0.71414 * Cr
-    B = Y + 1.772 * Cb
-    return np.stack((B, G, R), axis=0)
+    # Planar YCbCr in, interleaved (Y, X, 3) BGR out. Each channel is
+    # computed with int32 fixed-point arithmetic, clipped in place, and
+    # stored straight into its lane of the uint8 output.
+    Y = img[0].astype(np.int32)
+    Cb = img[1].astype(np.int32)
+    Cb -= shift
+    Cr = img[2].astype(np.int32)
+    Cr -= shift
+    out = np.empty(Y.shape + (3,), dtype=np.uint8)
+    for i, t in enumerate((CB_B * Cb, CB_G * Cb + CR_G * Cr, CR_R * Cr)):
+        t += 1 << 15 # round to nearest
+        t >>= 16
+        t += Y
+        np.clip(t, 0, 2 * shift - 1, out=t)
+        out[..., i] = t
+    return out
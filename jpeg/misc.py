@@ -1,90 +1,120 @@
 import numpy as np
 
-from .debug import debug
+from .debug import DEBUG, debug
+
+# F.2.2.1 EXTEND: a T-bit value with its top bit clear stands for v - (2^T - 1)
+EXTEND_OFFSET = [1 - (1 << t) for t in range(17)]
+
+def refill(data: bytes, pos: int, buf: int, bits: int):
+    # top up buf with as many whole bytes as fit in 64 bits,
+    # zero-padded past the end of data
+    k = (64 - bits) >> 3
+    val = int.from_bytes(data[pos: pos + k].ljust(k, b'\x00'), 'big')
+    return pos + k, (buf & ((1 << bits) - 1)) << (8 * k) | val, bits + 8 * k
+
 class BitStream:
     def __init__(self, data: bytes):
         self.data = data
-        self.offset = 0
+        # Bits are loaded from data a few bytes at a time into buf, of which
+        # the low `bits` bits have not been consumed yet.
+        self.pos = 0
+        self.buf = 0
+        self.bits = 0
 
     def tell(self):
-        return self.offset
+        return 8 * self.pos - self.bits
 
     def seek(self, offset: int, whence=0):
         if whence == 1:
-            self.offset += offset
-        else:
-            self.offset = offset
+            offset += self.tell()
+        self.pos, r = divmod(offset, 8)
+        self.buf = self.bits = 0
+        if r:
+            self.fill()
+            self.bits -= r
+
+    def fill(self):
+        self.pos, self.buf, self.bits = refill(self.data, self.pos, self.buf, self.bits)
+
+    def peek(self, n: int):
+        # next n bits (n <= 56) without consuming them
+        if self.bits < n:
+            self.fill()
+        return (self.buf >> (self.bits - n)) & ((1 << n) - 1)
+
+    def skip(self, n: int):
+        # consume n bits that were just peeked
+        self.bits -= n
 
     def read(self):
-        if self.offset // 8 >= len(self.data):
-            return 0
-        val = self.data[self.offset // 8]
-        val >>= 7 - self.offset % 8
-        val %= 2
-        self.offset += 1
+        val = self.peek(1)
+        self.bits -= 1
         return val
     
     def read_n(self, n: int):
+        # n <= 56 bits at once off the buffer
         assert n >= 0
-        ret = 0
-        for _ in range(n): ret = ret * 2 + self.read()
-        return ret
+        if self.bits < n:
+            self.fill()
+        self.bits -= n
+        return (self.buf >> self.bits) & ((1 << n) - 1)
 
     def read_signed(self, n: int):
         if n <= 0: return 0
-        ret = self.read_n(n)
+        if self.bits < n:
+            self.fill()
+        self.bits -= n
+        ret = (self.buf >> self.bits) & ((1 << n) - 1)
         if ret >> (n - 1) == 0:
-            ret -= 2 ** n - 1
+            ret += EXTEND_OFFSET[n]
         return ret
 
 class HuffmanTable:
-    def insert_sym(self, code: str, sym: int):
-        cur = self.nodes[0]
-        for c in code:
-            if c == '0': t = 0
-            else: t = 1
-            if cur[t] is None:
-                self.nodes.append([None, None, None])
-                cur[t] = self.nodes[-1]
-            cur = cur[t]
-        cur[2] = sym
-        
     def __init__(self, ht):
-        debug('Init HT')
-        debug(ht)
-        debug('Count:', sum(len(x) for x in ht))
-        self.nodes = [[None, None, None]] # [child-0, child-1, symbol]
+        if DEBUG:
+            debug('Init HT')
+            debug(ht)
+        # C.2 Generation of table of Huffman codes
+        # Every 16-bit string starting with a code maps to (symbol << 8) | code length
+        lookup = np.zeros(1 << 16, dtype=np.uint16)
         acc = 0
         for L in range(16):
             acc *= 2 # append 0
-            self.nodes.append([0, 0, 0])
             for x in ht[L]:
-                debug(f'{acc:0{L + 1}b}', x)
-                self.insert_sym(f'{acc:0{L + 1}b}', x)
+                if DEBUG: debug(f'{acc:0{L + 1}b}', x)
+                lookup[acc << (15 - L): (acc + 1) << (15 - L)] = x << 8 | (L + 1)
                 acc += 1
-        debug()
+        if DEBUG: debug()
+        # indexing a list from Python is much cheaper than indexing an ndarray
+        self.lookup = lookup.tolist()
 
     def next(self, stream: BitStream):
-        cur = self.nodes[0]
-        while cur[2] is None:
-            cur = cur[stream.read()]
-        return cur[2]
+        entry = self.lookup[stream.peek(16)]
+        if entry == 0:
+            raise ValueError(f"Invalid Huffman code at bit {stream.tell()}")
+        stream.skip(entry & 0xff)
+        return entry >> 8
+
+# Figure A.6 - Zig-zag sequence of quantized DCT coefficients
+ZIGZAG = np.array([
+    0, 1, 5, 6, 14, 15, 27, 28,
+    2, 4, 7, 13, 16, 26, 29, 42,
+    3, 8, 12, 17, 25, 30, 41, 43,
+    9, 11, 18, 24, 31, 40, 44, 53,
+    10, 19, 23, 32, 39, 45, 52, 54,
+    20, 22, 33, 38, 46, 51, 55, 60,
+    21, 34, 37, 47, 50, 56, 59, 61,
+    35, 36, 48, 49, 57, 58, 62, 63,
+], dtype=np.intp)
+# position within the 8x8 block of the k-th coefficient in zig-zag order
+UNZIGZAG = np.argsort(ZIGZAG)
 
 def ziglag(a: np.ndarray):
-    pos = np.array([
-        0, 1, 5, 6, 14, 15, 27, 28,
-        2, 4, 7, 13, 16, 26, 29, 42,
-        3, 8, 12, 17, 25, 30, 41, 43,
-        9, 11, 18, 24, 31, 40, 44, 53,
-        10, 19, 23, 32, 39, 45, 52, 54,
-        20, 22, 33, 38, 46, 51, 55, 60,
-        21, 34, 37, 47, 50, 56, 59, 61,
-        35, 36, 48, 49, 57, 58, 62, 63,
-    ])
-    return a[pos].reshape(8, 8)
+    # works on a single block or on a stack of blocks along the leading axes
+    return a[..., ZIGZAG].reshape(a.shape[:-1] + (8, 8))
 
 class DCT:
-    def __init__(self):
+    def __init__(self, dtype=np.float64):
         n = 8
         A = np.zeros((n, n))
         i, j = np.meshgrid(
@@ -92,14 +122,21 @@ class DCT:
         )
         A = np.sqrt(2 / n) * np.cos(np.pi / n * i * (j + 0.5))
         A[0] /= np.sqrt(2)
-        self.P = A
-        self.Q = A.T
+        self.P = A.astype(dtype)
+        self.Q = self.P.T
     
+    # Both transforms broadcast over leading axes, so a whole stack of
+    # blocks of shape (..., 8, 8) is transformed by two batched matmuls.
     def dct(self, a: np.ndarray):
-        assert a.shape == (8, 8)
+        assert a.shape[-2:] == (8, 8)
         return self.P @ a @ self.Q
     
     def idct(self, a: np.ndarray):
-        assert a.shape == (8, 8)
+        assert a.shape[-2:] == (8, 8)
         return self.Q @ a @ self.P
-        
\ No newline at end of file
+
+    def idct_matrix(self, q: np.ndarray):
+        # The 64x64 matrix K such that (c * q).flatten() fed through idct is
+        # c.flatten() @ K, i.e. dequantization by q folded into the IDCT.
+        assert q.shape == (8, 8)
+        return np.einsum('uv,xu,vy->uvxy', q, self.Q, self.P).reshape(64, 64).astype(self.P.dtype)